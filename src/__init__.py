@@ -1,2 +1,2 @@
-from .utils import generate_causal_mask, generate_causal_nat_mask, shift_tokens_right, compute_lr, model_size,\
-    model_n_parameters, SUPPORTED_LANGUAGES
+from .utils import generate_causal_mask, cached_causal_mask, generate_causal_nat_mask, shift_tokens_right, compute_lr,\
+    additive_padding_mask, merge_attention_masks, model_size, model_n_parameters, SUPPORTED_LANGUAGES
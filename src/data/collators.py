@@ -1,6 +1,9 @@
 import torch
+import math
 import random
 import numpy as np
+from torch.functional import F
+from torch.nn.utils.rnn import pad_sequence
 from transformers import PreTrainedTokenizer
 from transformers.utils import PaddingStrategy, TensorType
 from typing import Dict, List, Union
@@ -15,18 +18,44 @@ class BatchCollator:
                  padding: Union[bool, str, PaddingStrategy] = True,
                  add_special_tokens: bool = True,
                  return_tensors: Union[str, TensorType, None] = "pt",
-                 use_language_tokens: bool = True) -> None:
+                 use_language_tokens: bool = True,
+                 pad_to_multiple_of: Union[int, None] = None) -> None:
         self.tokenizer = tokenizer
         self.use_language_tokens = use_language_tokens
         self.collator_state = {"truncation": truncation, "max_length": max_length, "padding": padding,
-                               "add_special_tokens": add_special_tokens, "return_tensors": return_tensors}
+                               "add_special_tokens": add_special_tokens, "return_tensors": return_tensors,
+                               "pad_to_multiple_of": pad_to_multiple_of}
+
+    def _pad(self, sequences: List[torch.Tensor]) -> torch.Tensor:
+        # Pad the already tokenized sequences to the longest one, or to max_length if requested
+        padded_sequences = pad_sequence(sequences, batch_first=True, padding_value=self.tokenizer.pad_token_id)
+        seq_len = padded_sequences.shape[-1]
+        max_length = self.collator_state["max_length"]
+        pad_to_multiple_of = self.collator_state["pad_to_multiple_of"]
+        if self.collator_state["padding"] == PaddingStrategy.MAX_LENGTH and max_length is not None:
+            seq_len = max_length
+
+        # Rounding the length up to a multiple keeps the number of distinct batch shapes small
+        if pad_to_multiple_of is not None:
+            seq_len = math.ceil(seq_len / pad_to_multiple_of) * pad_to_multiple_of
+
+        if seq_len > padded_sequences.shape[-1]:
+            padded_sequences = F.pad(padded_sequences, (0, seq_len - padded_sequences.shape[-1]),
+                                     value=self.tokenizer.pad_token_id)
+
+        return padded_sequences
 
     def __call__(self, batch) -> Dict[str, torch.Tensor]:
-        # Build and tokenize the batches
-        input_ids_batch = [sentence_pair["src_sentence"] for sentence_pair in batch]
-        labels_batch = [sentence_pair["tgt_sentence"] for sentence_pair in batch]
-        input_ids_batch = self.tokenizer(input_ids_batch, **self.collator_state)["input_ids"]
-        labels_batch = self.tokenizer(text_target=labels_batch, **self.collator_state)["input_ids"]
+        if "input_ids" in batch[0]:
+            # The sentence pairs were already tokenized by the dataset, so they only need to be padded
+            input_ids_batch = self._pad([sentence_pair["input_ids"] for sentence_pair in batch])
+            labels_batch = self._pad([sentence_pair["labels"] for sentence_pair in batch])
+        else:
+            # Build and tokenize the batches
+            input_ids_batch = [sentence_pair["src_sentence"] for sentence_pair in batch]
+            labels_batch = [sentence_pair["tgt_sentence"] for sentence_pair in batch]
+            input_ids_batch = self.tokenizer(input_ids_batch, **self.collator_state)["input_ids"]
+            labels_batch = self.tokenizer(text_target=labels_batch, **self.collator_state)["input_ids"]
 
         # Language tokens are removed if requested
         if not self.use_language_tokens and hasattr(self.tokenizer, "src_lang") and hasattr(self.tokenizer, "tgt_lang"):
@@ -36,7 +65,13 @@ class BatchCollator:
             input_ids_batch = torch.where(input_ids_batch == src_lang_token, pad_token, input_ids_batch)
             labels_batch = torch.where(labels_batch == tgt_lang_token, pad_token, labels_batch)
 
-        return {"input_ids": input_ids_batch, "labels": labels_batch}
+        # Token ids are kept as int32 to halve the memory and the bytes to transfer, embeddings accept them as indices
+        input_ids_batch = input_ids_batch.to(torch.int32)
+        labels_batch = labels_batch.to(torch.int32)
+
+        # The encoder padding mask is built here, so that the workers compute it while the model is training
+        e_pad_mask = input_ids_batch == self.tokenizer.pad_token_id
+        return {"input_ids": input_ids_batch, "labels": labels_batch, "e_pad_mask": e_pad_mask}
 
 
 class BatchCollatorCMLM(BatchCollator):
@@ -49,9 +84,10 @@ class BatchCollatorCMLM(BatchCollator):
                  add_special_tokens: bool = True,
                  return_tensors: Union[str, TensorType, None] = "pt",
                  use_language_tokens: bool = True,
-                 train: bool = False) -> None:
+                 train: bool = False,
+                 pad_to_multiple_of: Union[int, None] = None) -> None:
         super().__init__(tokenizer, truncation, max_length, padding, add_special_tokens, return_tensors,
-                         use_language_tokens)
+                         use_language_tokens, pad_to_multiple_of)
         self.train = train
 
     def _mask_target(self, tgt: torch.Tensor) -> Dict[str, Union[torch.Tensor, List[int]]]:
@@ -105,4 +141,4 @@ class BatchCollatorCMLM(BatchCollator):
         masked_target = self._mask_target(labels)
         return {"input_ids": input_ids, "decoder_input_ids": masked_target["decoder_input_ids"],
                 "labels": masked_target["labels"], "mask_idxs": masked_target["mask_idxs"],
-                "n_masks": masked_target["n_masks"]}
+                "n_masks": masked_target["n_masks"], "e_pad_mask": tokenized_batch["e_pad_mask"]}
@@ -1,11 +1,17 @@
 import datasets
+import os
+import numpy as np
+import torch
 from torch.utils.data import Dataset
-from tqdm import tqdm
+from transformers import PreTrainedTokenizer
 from typing import Dict, Union
 
 
 class TranslationDataset(Dataset):
 
+    # Whether the raw sentences are cached, subclasses that do not return them from __getitem__ can skip it
+    _cache_sentences: bool = True
+
     def __init__(self,
                  src_lang: str,
                  tgt_lang: str,
@@ -21,32 +27,119 @@ class TranslationDataset(Dataset):
         self.avg_length_tgt = 0
         self.max_length_src = 0
         self.max_length_tgt = 0
+        self.avg_length_ratio = 0
+        self.std_length_ratio = 0
+
+        # Source and target sentences are extracted from the arrow table once as lists, so that retrieving a sample does
+        # not decode a whole row into a python dict (newer versions of datasets return lazy columns, hence the list)
+        if self._cache_sentences:
+            sentences = dataset.flatten()
+            self.src_sentences = list(sentences[f"translation.{src_lang}"])
+            self.tgt_sentences = list(sentences[f"translation.{tgt_lang}"])
+
+    def _compute_length_ratio(self, length_src: np.ndarray, length_tgt: np.ndarray) -> None:
+        # Ratio between target and source lengths, it can be used to bound the length of the generated translations
+        length_ratio = length_tgt / np.maximum(length_src, 1)
+        self.avg_length_ratio = float(np.mean(length_ratio))
+        self.std_length_ratio = float(np.std(length_ratio))
+
+    def compute_stats(self, num_proc: Union[int, None] = None) -> Dict[str, Union[int, float]]:
+        """
+        Computes max and average lengths of source and target sentences, and the mean and standard deviation of the
+        ratio between their lengths. The lengths are measured in whitespace separated words, so the length ratio is
+        only an approximation of the one between the number of tokens used by beam_decoding, prefer the one computed
+        by TokenizedTranslationDataset.
+        :param num_proc: number of processes used to compute the lengths, if None all the cpus are used
+            (default=None).
+        :return: dictionary containing the computed stats.
+        """
+        src_lang = self.src_lang
+        tgt_lang = self.tgt_lang
+
+        def sentences_lengths(batch: Dict[str, list]) -> Dict[str, list]:
+            return {"length_src": [len(sentence_pair[src_lang].split()) for sentence_pair in batch["translation"]],
+                    "length_tgt": [len(sentence_pair[tgt_lang].split()) for sentence_pair in batch["translation"]]}
 
-    def compute_stats(self) -> Dict[str, Union[int, float]]:
-        for sample in tqdm(self.dataset, "Computing average and max length for source and target"):
-            sentences = sample["translation"]
-            src_sentence: str = sentences[self.src_lang]
-            tgt_sentence: str = sentences[self.tgt_lang]
-            length_splitted_src = len(src_sentence.split())
-            length_splitted_tgt = len(tgt_sentence.split())
-            self.max_length_src = max(self.max_length_src, length_splitted_src)
-            self.max_length_tgt = max(self.max_length_tgt, length_splitted_tgt)
-            self.avg_length_src += length_splitted_src
-            self.avg_length_tgt += length_splitted_tgt
-
-        self.avg_length_src /= len(self.dataset)
-        self.avg_length_tgt /= len(self.dataset)
+        # Compute the lengths in parallel over batches of samples, then reduce them with numpy
+        lengths = self.dataset.map(sentences_lengths, batched=True, batch_size=1000,
+                                   num_proc=num_proc if num_proc is not None else os.cpu_count(),
+                                   remove_columns=self.dataset.column_names,
+                                   desc="Computing average and max length for source and target")
+        lengths = lengths.with_format("numpy")
+        length_src = np.asarray(lengths["length_src"])
+        length_tgt = np.asarray(lengths["length_tgt"])
+        self.max_length_src = int(np.max(length_src))
+        self.max_length_tgt = int(np.max(length_tgt))
+        self.avg_length_src = float(np.mean(length_src))
+        self.avg_length_tgt = float(np.mean(length_tgt))
+
+        self._compute_length_ratio(length_src, length_tgt)
         return {"max_length_src": self.max_length_src, "max_length_tgt": self.max_length_tgt,
-                "avg_length_src": self.avg_length_src, "avg_length_tgt": self.avg_length_tgt}
+                "avg_length_src": self.avg_length_src, "avg_length_tgt": self.avg_length_tgt,
+                "avg_length_ratio": self.avg_length_ratio, "std_length_ratio": self.std_length_ratio}
 
     def __len__(self) -> int:
         return len(self.dataset)
 
     def __getitem__(self, idx) -> Dict[str, str]:
-        sentence_pair = self.dataset[idx]["translation"]
-        src_sentence = sentence_pair[self.src_lang]
-        tgt_sentence = sentence_pair[self.tgt_lang]
-        return {"src_sentence": src_sentence, "tgt_sentence": tgt_sentence}
+        return {"src_sentence": self.src_sentences[idx], "tgt_sentence": self.tgt_sentences[idx]}
+
+
+class TokenizedTranslationDataset(TranslationDataset):
+
+    _cache_sentences = False
+
+    def __init__(self,
+                 src_lang: str,
+                 tgt_lang: str,
+                 dataset: datasets.Dataset,
+                 tokenizer: PreTrainedTokenizer,
+                 truncation: bool = True,
+                 max_length: Union[int, None] = None,
+                 num_proc: Union[int, None] = None) -> None:
+        """
+        Translation dataset whose sentence pairs are tokenized only once at construction time, so that each epoch
+        only needs to pad and stack the already computed token ids.
+        :param src_lang: the source language.
+        :param tgt_lang: the target language.
+        :param dataset: the huggingface dataset containing the sentence pairs.
+        :param tokenizer: the tokenizer used to encode source and target sentences.
+        :param truncation: whether to truncate the sentences to max_length (default=True).
+        :param max_length: the maximum length of the tokenized sentences (default=None).
+        :param num_proc: number of processes used to tokenize the dataset (default=None).
+        """
+        super().__init__(src_lang, tgt_lang, dataset)
+
+        def tokenize(batch: Dict[str, list]) -> Dict[str, list]:
+            src_sentences = [sentence_pair[src_lang] for sentence_pair in batch["translation"]]
+            tgt_sentences = [sentence_pair[tgt_lang] for sentence_pair in batch["translation"]]
+            tokenized_batch = tokenizer(src_sentences, text_target=tgt_sentences, truncation=truncation,
+                                        max_length=max_length)
+            return {"input_ids": tokenized_batch["input_ids"], "labels": tokenized_batch["labels"]}
+
+        tokenized_dataset = dataset.map(tokenize, batched=True, num_proc=num_proc,
+                                        remove_columns=dataset.column_names, desc="Tokenizing the dataset")
+        self.input_ids = [torch.tensor(input_ids, dtype=torch.int32) for input_ids in tokenized_dataset["input_ids"]]
+        self.labels = [torch.tensor(labels, dtype=torch.int32) for labels in tokenized_dataset["labels"]]
+        self.num_special_tokens = tokenizer.num_special_tokens_to_add()
+
+    def compute_stats(self, num_proc: Union[int, None] = None) -> Dict[str, Union[int, float]]:
+        """
+        Computes the same stats of TranslationDataset.compute_stats, but the length ratio is measured on the token ids
+        without the special tokens, which is the same unit used by beam_decoding to bound the translations length.
+        :param num_proc: number of processes used to compute the lengths, if None all the cpus are used
+            (default=None).
+        :return: dictionary containing the computed stats.
+        """
+        stats = super().compute_stats(num_proc)
+        length_src = np.array([len(input_ids) for input_ids in self.input_ids]) - self.num_special_tokens
+        length_tgt = np.array([len(labels) for labels in self.labels]) - self.num_special_tokens
+        self._compute_length_ratio(length_src, length_tgt)
+        stats.update(avg_length_ratio=self.avg_length_ratio, std_length_ratio=self.std_length_ratio)
+        return stats
+
+    def __getitem__(self, idx) -> Dict[str, torch.Tensor]:
+        return {"input_ids": self.input_ids[idx], "labels": self.labels[idx]}
 
 
 class TranslationDatasetCMLM(TranslationDataset):
@@ -58,7 +151,4 @@ class TranslationDatasetCMLM(TranslationDataset):
         super().__init__(src_lang, tgt_lang, dataset)
 
     def __getitem__(self, idx):
-        sentence_pair = self.dataset[idx]["translation"]
-        src_sentence = "<length> " + sentence_pair[self.src_lang]
-        tgt_sentence = sentence_pair[self.tgt_lang]
-        return {"src_sentence": src_sentence, "tgt_sentence": tgt_sentence}
+        return {"src_sentence": "<length> " + self.src_sentences[idx], "tgt_sentence": self.tgt_sentences[idx]}
@@ -1,7 +1,8 @@
 import torch
 from torch.functional import F
 from src.models import TransformerCore
-from ..utils import generate_causal_mask
+from ..utils import cached_causal_mask, additive_padding_mask
+from typing import List, Tuple
 
 
 def greedy_decoding(model: TransformerCore,
@@ -41,7 +42,7 @@ def greedy_decoding(model: TransformerCore,
         # Generate tokens in an autoregressive fashion
         for _ in range(1, max_length):
             # Obtain logits from the model's decoder
-            tgt_mask = generate_causal_mask(output.shape[-1]).to(device)
+            tgt_mask = cached_causal_mask(output.shape[-1], device)
             d_pad_mask = (output == pad_token_id).to(device)
             logits = model.decode(e_output, output, tgt_mask, e_pad_mask, d_pad_mask)
 
@@ -61,18 +62,221 @@ def greedy_decoding(model: TransformerCore,
         return output
 
 
-def beam_decoding(model: TransformerCore,
+def _encdec_keys_values(model: TransformerCore, e_output: torch.Tensor) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Projects the encodings into the keys and values of each decoder layer's encoder-decoder attention, this is done
+    only once per source sentence since they do not change during decoding.
+    :param model: the autoregressive model.
+    :param e_output: encodings coming from the encoder of shape (batch_size, seq_len, d_model).
+    :return: list of keys and values of shape (batch_size, n_heads, seq_len, head_dim) for each decoder layer.
+    """
+    batch_size, seq_len, _ = e_output.shape
+    keys_values = []
+    for decoder_layer in model.decoder.layers:
+        # The incremental decoding relies on the internals of nn.TransformerDecoderLayer, the layers must use packed
+        # input projections and batch first inputs
+        attention = decoder_layer.multihead_attn
+        assert isinstance(decoder_layer, torch.nn.TransformerDecoderLayer), "Unsupported decoder layer."
+        assert attention.in_proj_weight is not None, "The encoder-decoder attention must use packed projections."
+        assert attention.batch_first, "The encoder-decoder attention must expect batch first inputs."
+        head_dim = attention.embed_dim // attention.num_heads
+        _, w_k, w_v = attention.in_proj_weight.chunk(3)
+        _, b_k, b_v = attention.in_proj_bias.chunk(3)
+        k = F.linear(e_output, w_k, b_k).view(batch_size, seq_len, attention.num_heads, head_dim).transpose(1, 2)
+        v = F.linear(e_output, w_v, b_v).view(batch_size, seq_len, attention.num_heads, head_dim).transpose(1, 2)
+        keys_values.append((k, v))
+
+    return keys_values
+
+
+def _encdec_block(decoder_layer: torch.nn.TransformerDecoderLayer,
                   x: torch.Tensor,
+                  k: torch.Tensor,
+                  v: torch.Tensor,
+                  e_mask: torch.Tensor) -> torch.Tensor:
+    # The beams of each sentence are folded in the queries length, so that they all attend the keys and values of
+    # their source sentence without replicating them for each beam
+    attention = decoder_layer.multihead_attn
+    batch_size, n_heads, _, head_dim = k.shape
+    n_beams, seq_len, d_model = x.shape
+    w_q, _, _ = attention.in_proj_weight.chunk(3)
+    b_q, _, _ = attention.in_proj_bias.chunk(3)
+    q = F.linear(x, w_q, b_q).view(batch_size, -1, n_heads, head_dim).transpose(1, 2)
+    output = F.scaled_dot_product_attention(q, k, v, attn_mask=e_mask)
+    output = output.transpose(1, 2).reshape(n_beams, seq_len, d_model)
+    return decoder_layer.dropout2(attention.out_proj(output))
+
+
+def _beam_decode(model: TransformerCore,
+                 tgt_input: torch.Tensor,
+                 keys_values: List[Tuple[torch.Tensor, torch.Tensor]],
+                 e_mask: torch.Tensor) -> torch.Tensor:
+    """
+    Decodes the beams given the precomputed keys and values of the encoder-decoder attentions.
+    :param model: the autoregressive model.
+    :param tgt_input: the beams of shape (batch_size * beam_size, seq_len).
+    :param keys_values: keys and values of each decoder layer computed by _encdec_keys_values.
+    :param e_mask: additive key padding mask for the encoder of shape (batch_size, 1, 1, seq_len).
+    :return: the logits of the last position of each beam with shape (batch_size * beam_size, tgt_vocab_size).
+    """
+    d_mask = cached_causal_mask(tgt_input.shape[-1], tgt_input.device)
+    x = model._scaled_positional_encoding(model.tgt_embedding(tgt_input))
+    for decoder_layer, (k, v) in zip(model.decoder.layers, keys_values):
+        # This mirrors nn.TransformerDecoderLayer.forward, only the encoder-decoder attention block is replaced by
+        # _encdec_block so that the precomputed keys and values are used, keep them aligned when updating torch
+        if decoder_layer.norm_first:
+            x = x + decoder_layer._sa_block(decoder_layer.norm1(x), d_mask, None)
+            x = x + _encdec_block(decoder_layer, decoder_layer.norm2(x), k, v, e_mask)
+            x = x + decoder_layer._ff_block(decoder_layer.norm3(x))
+        else:
+            x = decoder_layer.norm1(x + decoder_layer._sa_block(x, d_mask, None))
+            x = decoder_layer.norm2(x + _encdec_block(decoder_layer, x, k, v, e_mask))
+            x = decoder_layer.norm3(x + decoder_layer._ff_block(x))
+
+    if model.decoder.norm is not None:
+        x = model.decoder.norm(x)
+
+    return model.linear_output(x[:, -1])
+
+
+# Whether _beam_decode has already been checked against the model's decoder
+_beam_decode_checked = False
+
+
+def _check_beam_decode(model: TransformerCore,
+                       e_output: torch.Tensor,
+                       e_pad_mask: torch.Tensor,
+                       keys_values: List[Tuple[torch.Tensor, torch.Tensor]],
+                       e_mask: torch.Tensor,
+                       sos_token_id: int,
+                       beam_size: int) -> None:
+    # Since _beam_decode re-implements nn.TransformerDecoderLayer.forward, its logits are compared once with the ones
+    # of the model's decoder, so that a change in the torch internals does not silently alter the translations
+    global _beam_decode_checked
+    _beam_decode_checked = True
+    tgt_input = torch.full((e_output.shape[0] * beam_size, 3), sos_token_id, device=e_output.device)
+    beam_logits = _beam_decode(model, tgt_input, keys_values, e_mask)
+    decoder_logits = model.decode(e_output.repeat_interleave(beam_size, dim=0), tgt_input,
+                                  cached_causal_mask(tgt_input.shape[-1], tgt_input.device),
+                                  e_pad_mask.repeat_interleave(beam_size, dim=0))[:, -1]
+    assert torch.allclose(beam_logits.float(), decoder_logits.float(), rtol=1e-3, atol=1e-3), \
+        "The beam search decoding does not match the model's decoder."
+
+
+def beam_decoding(model: TransformerCore,
+                  input_ids: torch.Tensor,
                   sos_token_id: int,
                   eos_token_id: int,
-                  max_length: int = None,
-                  beam_size: int = 2) -> torch.Tensor:
+                  pad_token_id: int,
+                  max_new_tokens: int = 10,
+                  beam_size: int = 4,
+                  max_length_ratio: float = None,
+                  num_special_tokens: int = 2) -> torch.Tensor:
+    """
+    Performs beam search for translating tokenized input sentence, this should be used only by autoregressive
+    transformers. The encodings, and the keys and values of the encoder-decoder attentions, are computed once for
+    each sentence and shared by all of its beams. Sentences leave the batch as soon as their best beam is finished
+    or they reach their maximum length, so that the remaining steps only decode the unfinished ones.
+    :param model: the autoregressive model.
+    :param input_ids: the tokenized input sentence of shape (batch_size, seq_len).
+    :param sos_token_id: start of sentence token id.
+    :param eos_token_id: end of sentence token id, for multilingual models this should be the target language code id.
+    :param pad_token_id: pad token id.
+    :param max_new_tokens: maximum allowed new tokens.
+    :param beam_size: the number of beams kept for each sentence.
+    :param max_length_ratio: if passed, the number of tokens of each translation, special tokens excluded, is also
+        bounded by the number of tokens of its source sentence times this ratio, e.g.: avg_length_ratio +
+        2 * std_length_ratio from TokenizedTranslationDataset.compute_stats (default=None).
+    :param num_special_tokens: number of special tokens added by the tokenizer to each sentence, they are not taken
+        into account by max_length_ratio (default=2, the eos and language code tokens of mBart).
+    :return: the tokenized translated sentence with the highest score.
+    """
     with torch.no_grad():
-        if max_length is None:
-            max_length = x.shape[-1]
-
+        # Parameters
+        max_length = input_ids.shape[-1] + max_new_tokens
         device = next(model.parameters()).device
-        x = x.to(device)
-        output = torch.ones(1, 1, dtype=torch.int).fill_(sos_token_id).to(device)
-        e_output = model.encode(x)
-    pass
+        input_ids = input_ids.to(device)
+        batch_size = input_ids.shape[0]
+
+        # Encode the input tokens and project the encodings for the encoder-decoder attentions only once
+        e_pad_mask = input_ids == pad_token_id
+        e_output = model.encode(input_ids, e_pad_mask=e_pad_mask)
+        keys_values = _encdec_keys_values(model, e_output)
+        e_mask = additive_padding_mask(e_pad_mask, e_output.dtype)
+        if __debug__ and not _beam_decode_checked and not model.training:
+            _check_beam_decode(model, e_output, e_pad_mask, keys_values, e_mask, sos_token_id, beam_size)
+
+        # Maximum length of each sentence, the ratio is applied to the source tokens without the special ones, which are
+        # then added back to the bound
+        max_lengths = torch.full((batch_size,), max_length, device=device)
+        if max_length_ratio is not None:
+            src_lengths = ((~e_pad_mask).sum(dim=-1) - num_special_tokens).clamp(min=1)
+            ratio_lengths = torch.ceil(src_lengths * max_length_ratio).long() + num_special_tokens
+            max_lengths = torch.minimum(max_lengths, ratio_lengths)
+
+        # Set the first token of each beam as the sos token (target language code if using mBart), only the first
+        # beam of each sentence is alive at the beginning so that the first step does not select the same tokens
+        output = torch.ones(batch_size * beam_size, 1, dtype=torch.int).fill_(sos_token_id).to(device)
+        beam_scores = torch.zeros(batch_size, beam_size, device=device)
+        beam_scores[:, 1:] = float("-inf")
+        beam_scores = beam_scores.view(-1)
+
+        # Keep track of finished beams (the ones for which the eos token was already generated) and of the sentences
+        # still being translated
+        finished_beams = torch.zeros(batch_size * beam_size, dtype=torch.bool, device=device)
+        active_sentences = torch.arange(batch_size, device=device)
+        translations = torch.ones(batch_size, max_length, dtype=torch.int).fill_(pad_token_id).to(device)
+        translations_length = 1
+
+        # Generate tokens in an autoregressive fashion
+        for _ in range(1, max_length):
+            n_active = active_sentences.shape[0]
+            logits = _beam_decode(model, output, keys_values, e_mask)
+            log_probs = F.log_softmax(logits.float(), dim=-1)  # (n_active * beam_size, tgt_vocab_size)
+
+            # Finished beams can only be extended by pad tokens, which do not change their score
+            log_probs.masked_fill_(finished_beams.unsqueeze(1), float("-inf"))
+            log_probs[:, pad_token_id].masked_fill_(finished_beams, 0)
+
+            # Select the best beam_size continuations among all the beams of each sentence
+            vocab_size = log_probs.shape[-1]
+            scores = (beam_scores.unsqueeze(1) + log_probs).view(n_active, beam_size * vocab_size)
+            beam_scores, idxs = scores.topk(beam_size, dim=-1)  # (n_active, beam_size)
+            beam_offsets = torch.arange(n_active, device=device).unsqueeze(1) * beam_size
+            beam_idxs = (idxs // vocab_size + beam_offsets).view(-1)
+            new_tokens = (idxs % vocab_size).view(-1)
+
+            # Reorder the beams and concatenate the new tokens to the previously generated ones
+            output = torch.cat([output[beam_idxs], new_tokens.unsqueeze(1).to(output.dtype)], dim=-1)
+            finished_beams = finished_beams[beam_idxs] | (new_tokens == eos_token_id)
+            beam_scores = beam_scores.view(-1)
+
+            # Scores can only decrease and beams are sorted by them, so a sentence is done as soon as its best beam is
+            # finished, or when it reaches its maximum length
+            seq_len = output.shape[-1]
+            finished_sentences = finished_beams.view(n_active, beam_size)[:, 0] | (max_lengths <= seq_len)
+            if not finished_sentences.any():
+                continue
+
+            # Beams are sorted by score, so the first one of each finished sentence is its translation
+            finished_idxs = finished_sentences.nonzero().squeeze(1)
+            best_beams = output.view(n_active, beam_size, seq_len)[finished_idxs, 0]
+            translations[active_sentences[finished_idxs], :seq_len] = best_beams
+            translations_length = seq_len
+
+            # Terminates if all the sentences have been translated
+            active_idxs = (~finished_sentences).nonzero().squeeze(1)
+            if active_idxs.numel() == 0:
+                break
+
+            # Remove the finished sentences from the batch, together with their beams and cached encodings
+            active_beams = (active_idxs.unsqueeze(1) * beam_size + torch.arange(beam_size, device=device)).view(-1)
+            active_sentences = active_sentences[active_idxs]
+            max_lengths = max_lengths[active_idxs]
+            keys_values = [(k.index_select(0, active_idxs), v.index_select(0, active_idxs)) for k, v in keys_values]
+            e_mask = e_mask.index_select(0, active_idxs)
+            output = output.index_select(0, active_beams)
+            beam_scores = beam_scores.index_select(0, active_beams)
+            finished_beams = finished_beams.index_select(0, active_beams)
+
+        return translations[:, :translations_length]
@@ -1,5 +1,4 @@
 import torch
-import math
 from torch import nn
 from . import TransformerCore
 from ..modules import Pooler
@@ -56,8 +55,8 @@ class CMLM(TransformerCore):
         # Embeddings and positional encoding
         e_input = self.src_embedding(src_input)  # (batch_size, seq_len, d_model)
         d_input = self.tgt_embedding(tgt_input)  # (batch_size, seq_len, d_model)
-        e_input = self.positional_encoder(e_input * math.sqrt(self.d_model))
-        d_input = self.positional_encoder(d_input * math.sqrt(self.d_model))
+        e_input = self._scaled_positional_encoding(e_input)
+        d_input = self._scaled_positional_encoding(d_input)
 
         # Encoder and decoder
         e_output = self.encoder(e_input, None, e_pad_mask)
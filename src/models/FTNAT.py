@@ -1,8 +1,7 @@
 import torch
-import math
 from torch import nn
 from . import TransformerCore
-from ..modules import DecoderLayerNAT, DecoderNAT, Fertility
+from ..modules import DecoderNAT, build_decoder_layer_nat, Fertility
 
 
 class FTNAT(TransformerCore):
@@ -53,7 +52,7 @@ class FTNAT(TransformerCore):
         self.fertility = Fertility(d_model, max_fertilities)
 
         # Decoder
-        decoder_layer = DecoderLayerNAT(d_model, n_heads, dim_ff, dropout, layer_norm_eps, norm_first)
+        decoder_layer = build_decoder_layer_nat(d_model, n_heads, dim_ff, dropout, layer_norm_eps, norm_first)
         norm = nn.LayerNorm(d_model, layer_norm_eps) if norm_first else None
         self.decoder = DecoderNAT(decoder_layer, num_decoder_layers, norm)
 
@@ -82,7 +81,7 @@ class FTNAT(TransformerCore):
         """
         # Embeddings and positional encoding
         e_embeddings = self.src_embedding(src_input)
-        e_input = self.positional_encoder(e_embeddings * math.sqrt(self.d_model))
+        e_input = self._scaled_positional_encoding(e_embeddings)
 
         # Encoder and fertilities
         e_output = self.encoder(e_input, None, padding_mask)
@@ -93,9 +92,9 @@ class FTNAT(TransformerCore):
             copied_embeddings = e_embeddings
 
         # Decoder
-        d_input = self.positional_encoder(copied_embeddings * math.sqrt(self.d_model))
+        d_input = self._scaled_positional_encoding(copied_embeddings)
         d_input = self.positional_dropout(d_input)
-        d_output = self.decoder(d_input, e_output, d_mask, padding_mask, padding_mask)
+        d_output = self.decoder(e_output, d_input, self.pe, d_mask, padding_mask, padding_mask)
 
         # Linear output
         output = self.linear_output(d_output)  # (batch_size, seq_len, tgt_vocab_size)
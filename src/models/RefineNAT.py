@@ -1,7 +1,6 @@
 import torch
-import math
 from torch import nn
-from ..modules import DecoderLayerNAT, DecoderNAT
+from ..modules import DecoderNAT, build_decoder_layer_nat
 from . import TransformerCore
 
 
@@ -29,8 +28,8 @@ class RefineNAT(TransformerCore):
         self.use_highway_layer = use_highway_layer
 
         # Decoders
-        decoder_layer = DecoderLayerNAT(d_model, n_heads, dim_ff, dropout, layer_norm_eps, norm_first,
-                                        use_highway_layer)
+        decoder_layer = build_decoder_layer_nat(d_model, n_heads, dim_ff, dropout, layer_norm_eps, norm_first,
+                                                use_highway_layer)
         norm = nn.LayerNorm(d_model, layer_norm_eps)
         self.decoder = DecoderNAT(decoder_layer, num_decoder_layers, norm)
         norm1 = nn.LayerNorm(d_model, layer_norm_eps)
@@ -50,14 +49,14 @@ class RefineNAT(TransformerCore):
         """
         # Encoder
         e_input = self.src_embedding(src_input)  # (batch_size, seq_len, d_model)
-        e_input = self.positional_encoder(e_input * math.sqrt(self.d_model))
+        e_input = self._scaled_positional_encoding(e_input)
         e_output = self.encoder(e_input, None, e_pad_mask)
 
         # Decoder
         d_input = self.tgt_embedding(tgt_input)  # (batch_size, seq_len, d_model)
-        d_input = self.positional_encoder(d_input * math.sqrt(self.d_model))
-        d_output = self.decoder(src_input, e_output, d_mask, None, d_pad_mask, e_pad_mask)
-        d_output = self.decoder1(d_input, d_output, d_mask, None, d_pad_mask, e_pad_mask)
+        d_input = self._scaled_positional_encoding(d_input)
+        d_output = self.decoder(e_output, d_input, self.pe, d_mask, e_pad_mask, d_pad_mask)
+        d_output = self.decoder1(e_output, d_output, self.pe, d_mask, e_pad_mask, d_pad_mask)
 
         # Linear output
         output = self.linear_output(d_output)  # (batch_size, seq_len, tgt_vocab_size)
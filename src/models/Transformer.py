@@ -1,5 +1,4 @@
 import torch
-import math
 from torch import nn
 from .TransformerCore import TransformerCore
 from ..inference import greedy_decoding, beam_decoding
@@ -67,9 +66,9 @@ class Transformer(TransformerCore):
         """
         # Embeddings and positional encoding
         e_input = self.src_embedding(src_input)  # (batch_size, seq_len, d_model)
-        e_input = self.positional_encoder(e_input * math.sqrt(self.d_model))
+        e_input = self._scaled_positional_encoding(e_input)
         d_input = self.tgt_embedding(tgt_input)  # (batch_size, seq_len, d_model)
-        d_input = self.positional_encoder(d_input * math.sqrt(self.d_model))
+        d_input = self._scaled_positional_encoding(d_input)
 
         # Encoder and decoder
         e_output = self.encoder(e_input, None, e_pad_mask)
@@ -86,10 +85,13 @@ class Transformer(TransformerCore):
                  eos_token_id: int,
                  pad_token_id: int,
                  max_new_tokens: int = 10,
-                 beam_size: int = 4) -> torch.Tensor:
+                 beam_size: int = 4,
+                 max_length_ratio: float = None,
+                 num_special_tokens: int = 2) -> torch.Tensor:
         if beam_size == 1:
             output = greedy_decoding(self, input_ids, sos_token_id, eos_token_id, pad_token_id, max_new_tokens)
         else:
-            output = beam_decoding(self, input_ids, sos_token_id, eos_token_id, beam_size=beam_size)
+            output = beam_decoding(self, input_ids, sos_token_id, eos_token_id, pad_token_id, max_new_tokens,
+                                   beam_size, max_length_ratio, num_special_tokens)
 
         return output
@@ -1,24 +1,39 @@
 import torch
 import math
 from torch import nn
-
-
-class PositionalEncoding(nn.Module):
-
-    def __init__(self, d_model: int = 512, max_len: int = 5000, dropout: float = 0.1) -> None:
-        super().__init__()
-        self.dropout = nn.Dropout(dropout)
-        position = torch.arange(max_len).unsqueeze(1)
-        div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
-        pe = torch.zeros(max_len, d_model)
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)
-        self.register_buffer("pe", pe)
-
-    def forward(self, x) -> torch.Tensor:
-        x = x + self.pe[:, x.size(1), :]
-        return self.dropout(x)
+from torch.functional import F
+
+
+def sinusoidal_positional_encoding(d_model: int = 512, max_len: int = 5000) -> torch.Tensor:
+    """
+    Builds the sinusoidal positional encoding table by Vaswani et al. https://arxiv.org/pdf/1706.03762.pdf.
+    :param d_model: the model's embedding dimension (default=512).
+    :param max_len: the maximum sequence length (default=5000).
+    :return: torch tensor of shape (1, max_len, d_model).
+    """
+    position = torch.arange(max_len).unsqueeze(1)
+    div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
+    pe = torch.zeros(max_len, d_model)
+    pe[:, 0::2] = torch.sin(position * div_term)
+    pe[:, 1::2] = torch.cos(position * div_term)
+    return pe.unsqueeze(0)
+
+
+def scaled_positional_encoding(x: torch.Tensor, pe: torch.Tensor, scale: float, p: float,
+                               training: bool) -> torch.Tensor:
+    """
+    Scales the embeddings, adds the positional encoding and applies dropout as a single function. In eager mode these
+    are still three separate kernels, the elementwise operations are fused, and the (batch_size, seq_len, d_model)
+    tensor read and written once, only when the whole model is wrapped by torch.compile (see compile_model in
+    train.py).
+    :param x: the embeddings of shape (batch_size, seq_len, d_model).
+    :param pe: the positional encoding of shape (1, max_len, d_model).
+    :param scale: the value by which the embeddings are multiplied.
+    :param p: the dropout value.
+    :param training: whether the dropout should be applied.
+    :return: torch tensor of shape (batch_size, seq_len, d_model).
+    """
+    return F.dropout(x * scale + pe[:, :x.size(1)], p, training)
 
 
 class TransformerCore(nn.Module):
@@ -85,7 +100,9 @@ class TransformerCore(nn.Module):
         if share_embeddings_src_tgt or tgt_vocab_size is None:
             self.tgt_embedding.weight = self.src_embedding.weight
 
-        self.positional_encoder = PositionalEncoding(d_model, dropout=dropout)
+        # The positional encoding table is precomputed once and moves with the model's device and dtype
+        self.embedding_scale = math.sqrt(d_model)
+        self.register_buffer("pe", sinusoidal_positional_encoding(d_model), persistent=False)
 
         # Encoder and decoder
         encoder_layer = nn.TransformerEncoderLayer(d_model, n_heads, dim_ff, dropout, layer_norm_eps=layer_norm_eps,
@@ -102,6 +119,14 @@ class TransformerCore(nn.Module):
         if share_embeddings_tgt_out:
             self.linear_output.weight = self.tgt_embedding.weight
 
+    def _scaled_positional_encoding(self, embeddings: torch.Tensor) -> torch.Tensor:
+        """
+        Scales the embeddings, adds the positional encoding and applies dropout.
+        :param embeddings: torch tensor of shape (batch_size, seq_len, d_model).
+        :return: torch tensor of shape (batch_size, seq_len, d_model).
+        """
+        return scaled_positional_encoding(embeddings, self.pe, self.embedding_scale, self.dropout, self.training)
+
     def encode(self,
                e_input: torch.Tensor,
                e_mask: torch.Tensor = None,
@@ -114,7 +139,7 @@ class TransformerCore(nn.Module):
         :return: torch tensor representing the encodings with shape (batch_size, seq_len, d_model).
         """
         src_embeddings = self.src_embedding(e_input)  # (batch_size, seq_len, d_model)
-        src_embeddings = self.positional_encoder(src_embeddings * math.sqrt(self.d_model))
+        src_embeddings = self._scaled_positional_encoding(src_embeddings)
         e_output = self.encoder(src_embeddings, e_mask, e_pad_mask)
         return e_output
 
@@ -136,7 +161,7 @@ class TransformerCore(nn.Module):
             (batch_size, seq_len, tgt_vocab_size) if generate_logits is True.
         """
         tgt_embeddings = self.tgt_embedding(tgt_input)  # (batch_size, seq_len, d_model)
-        tgt_embeddings = self.positional_encoder(tgt_embeddings * math.sqrt(self.d_model))
+        tgt_embeddings = self._scaled_positional_encoding(tgt_embeddings)
         d_output = self.decoder(tgt_embeddings, e_output, d_mask, None, d_pad_mask, e_pad_mask)
         d_output = self.linear_output(d_output)  # (batch_size, seq_len, tgt_vocab_size)
         return d_output
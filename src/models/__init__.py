@@ -1,4 +1,4 @@
-from .TransformerCore import TransformerCore, PositionalEncoding
+from .TransformerCore import TransformerCore, sinusoidal_positional_encoding
 from .Transformer import Transformer
 from .FTNAT import FTNAT
 from .RefineNAT import RefineNAT
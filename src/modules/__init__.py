@@ -1,3 +1,4 @@
 from .connections import ResidualConnection, HighwayConnection
-from .layersNAT import DecoderLayerNAT, DecoderNAT
+from .attention import MultiHeadAttention
+from .layersNAT import PreNormDecoderLayerNAT, PostNormDecoderLayerNAT, DecoderNAT, build_decoder_layer_nat
 from .pooling import Fertility, Pooler
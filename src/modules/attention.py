@@ -0,0 +1,76 @@
+import torch
+from torch import nn
+from torch.functional import F
+
+
+class MultiHeadAttention(nn.Module):
+
+    def __init__(self, d_model: int = 512, n_heads: int = 8, dropout: float = 0.0, bias: bool = True) -> None:
+        """
+        Multi-head attention by Vaswani et al. https://arxiv.org/pdf/1706.03762.pdf computed through
+        scaled_dot_product_attention, which dispatches to the fused FlashAttention or memory-efficient kernels when
+        they are available, so that the attention weights of shape (batch_size, n_heads, seq_len, seq_len) are never
+        materialized. The module expects inputs with the format (batch_size, seq_len, d_model).
+        :param d_model: the model's embedding dimension (default=512).
+        :param n_heads: the number of heads in the multi-attention mechanism (default=8).
+        :param dropout: the dropout value applied to the attention weights (default=0.0).
+        :param bias: whether to add a bias to the input and output projections (default=True).
+        """
+        super().__init__()
+        if d_model % n_heads != 0:
+            raise ValueError("The embedding dimension must be divisible by the number of heads.")
+
+        # Parameters
+        self.d_model = d_model
+        self.n_heads = n_heads
+        self.head_dim = d_model // n_heads
+        self.dropout = dropout
+
+        # Query, key and value projections are stacked in a single linear layer, followed by the output projection
+        self.in_proj = nn.Linear(d_model, 3 * d_model, bias=bias)
+        self.out_proj = nn.Linear(d_model, d_model, bias=bias)
+        self._reset_parameters()
+
+    def _reset_parameters(self) -> None:
+        # Same initialization of nn.MultiheadAttention, the output projection weights keep the nn.Linear default
+        nn.init.xavier_uniform_(self.in_proj.weight)
+        if self.in_proj.bias is not None:
+            nn.init.zeros_(self.in_proj.bias)
+            nn.init.zeros_(self.out_proj.bias)
+
+    def _split_heads(self, x: torch.Tensor) -> torch.Tensor:
+        batch_size, seq_len, _ = x.shape
+        return x.view(batch_size, seq_len, self.n_heads, self.head_dim).transpose(1, 2)
+
+    def forward(self,
+                query: torch.Tensor,
+                key: torch.Tensor,
+                value: torch.Tensor,
+                attn_mask: torch.Tensor = None) -> torch.Tensor:
+        """
+        Computes the multi-head attention.
+        :param query: torch tensor of shape (batch_size, tgt_len, d_model).
+        :param key: torch tensor of shape (batch_size, src_len, d_model).
+        :param value: torch tensor of shape (batch_size, src_len, d_model).
+        :param attn_mask: additive attention mask broadcastable to (batch_size, n_heads, tgt_len, src_len) with the same
+            dtype of the projected queries, it can be built once for all the layers by merge_attention_masks.
+        :return: torch tensor of shape (batch_size, tgt_len, d_model).
+        """
+        # Project queries, keys and values, self-attention needs a single matrix multiplication
+        if query is key and key is value:
+            q, k, v = self.in_proj(query).chunk(3, dim=-1)
+        else:
+            w_q, w_k, w_v = self.in_proj.weight.chunk(3)
+            b_q, b_k, b_v = self.in_proj.bias.chunk(3) if self.in_proj.bias is not None else (None, None, None)
+            q = F.linear(query, w_q, b_q)
+            k = F.linear(key, w_k, b_k)
+            v = F.linear(value, w_v, b_v)
+
+        # Fused attention over the heads
+        q, k, v = self._split_heads(q), self._split_heads(k), self._split_heads(v)
+        output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                                dropout_p=self.dropout if self.training else 0.0)
+
+        # Concatenate the heads and project them
+        output = output.transpose(1, 2).reshape(query.shape[0], query.shape[1], self.d_model)
+        return self.out_proj(output)
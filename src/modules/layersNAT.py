@@ -1,11 +1,18 @@
 import torch
+import copy
+import math
+from abc import ABC, abstractmethod
 from torch import nn
 from torch.functional import F
-from src.models import PositionalEncoding
-from . import ResidualConnection, HighwayConnection
+from torch.utils.checkpoint import checkpoint
+from ..utils import merge_attention_masks
+from . import ResidualConnection, HighwayConnection, MultiHeadAttention
 
 
-class DecoderLayerNAT(nn.Module):
+class DecoderLayerNAT(nn.Module, ABC):
+
+    # Placement of the layer normalization, it is fixed by the subclasses so that their forward has no branches on it
+    norm_first: bool = False
 
     def __init__(self,
                  d_model: int = 512,
@@ -13,7 +20,7 @@ class DecoderLayerNAT(nn.Module):
                  dim_ff: int = 2048,
                  dropout: float = 0.1,
                  layer_norm_eps: float = 1e-5,
-                 norm_first: bool = False,
+                 *,
                  use_highway_layer: bool = False) -> None:
         """
         The non-autoregressive transformer decoder layer as first introduced by Gu et al.
@@ -28,13 +35,12 @@ class DecoderLayerNAT(nn.Module):
         :param dropout: the dropout value (default=0.1).
         :param layer_norm_eps: the eps value in the layer normalization (default=1e-6).
         :param use_highway_layer: whether to use a highway connection around each sublayer, if set to False then
-            residual connections will be used (default=True)
+            residual connections will be used (default=False)
         """
         super().__init__()
         # Parameters
-        self.norm_first = norm_first
+        self.d_model = d_model
         self.use_highway_layer = use_highway_layer
-        self.positional_encoder = PositionalEncoding(d_model, dropout=0)
 
         # Connections around each layer
         if use_highway_layer:
@@ -43,15 +49,15 @@ class DecoderLayerNAT(nn.Module):
             self.block_connections = nn.ModuleList([ResidualConnection(dropout) for _ in range(4)])
 
         # Self-attention sublayer
-        self.self_attention = nn.MultiheadAttention(d_model, n_heads, dropout, batch_first=True)
+        self.self_attention = MultiHeadAttention(d_model, n_heads, dropout)
         self.norm1 = nn.LayerNorm(d_model, layer_norm_eps)
 
         # Positional attention sublayer
-        self.pos_attention = nn.MultiheadAttention(d_model, n_heads, dropout, batch_first=True)
+        self.pos_attention = MultiHeadAttention(d_model, n_heads, dropout)
         self.norm2 = nn.LayerNorm(d_model, layer_norm_eps)
 
         # Encoder-decoder attention sublayer
-        self.encdec_attention = nn.MultiheadAttention(d_model, n_heads, dropout, batch_first=True)
+        self.encdec_attention = MultiHeadAttention(d_model, n_heads, dropout)
         self.norm3 = nn.LayerNorm(d_model, layer_norm_eps)
 
         # Feed-forward sublayer
@@ -60,84 +66,191 @@ class DecoderLayerNAT(nn.Module):
         self.ff_linear2 = nn.Linear(dim_ff, d_model)
         self.norm4 = nn.LayerNorm(d_model, layer_norm_eps)
 
-    def _maybe_layer_norm(self,
-                          x: torch.Tensor,
-                          norm: nn.Module,
-                          before: bool = False,
-                          after: bool = False) -> torch.Tensor:
-        assert before ^ after
-        if after ^ self.norm_first:
-            return norm(x)
-        else:
-            return x
+    def _ff_block(self, x: torch.Tensor) -> torch.Tensor:
+        x = F.relu(self.ff_linear1(x))
+        x = self.dropout(x)
+        return self.ff_linear2(x)
 
+    @abstractmethod
     def forward(self,
                 e_output: torch.Tensor,
                 tgt_input: torch.Tensor,
+                pe: torch.Tensor,
                 d_mask: torch.Tensor = None,
-                e_pad_mask: torch.Tensor = None,
-                d_pad_mask: torch.Tensor = None) -> torch.Tensor:
+                e_pad_mask: torch.Tensor = None) -> torch.Tensor:
         """
         Process masked source and target sequences.
+        :param pe: positional encoding of shape (1, seq_len, d_model) shared by all the decoder layers, it is added to
+            the self-attention output to build the query and key of the positional attention.
+        :param d_mask: additive mask for the decoder, already merged with its key padding mask, of shape
+            (batch_size, 1, seq_len, seq_len).
+        :param e_pad_mask: additive key padding mask for the encoder of shape (batch_size, 1, 1, seq_len).
         """
+
+
+class PreNormDecoderLayerNAT(DecoderLayerNAT):
+    """
+    Non-autoregressive decoder layer that performs the LayerNorms before the attention and feedforward sublayers.
+    """
+
+    norm_first = True
+
+    def forward(self,
+                e_output: torch.Tensor,
+                tgt_input: torch.Tensor,
+                pe: torch.Tensor,
+                d_mask: torch.Tensor = None,
+                e_pad_mask: torch.Tensor = None) -> torch.Tensor:
         # Self-attention sublayer
-        sa_output = self._maybe_layer_norm(tgt_input, self.norm1, before=True)
-        sa_output = self.self_attention(sa_output, sa_output, sa_output, d_pad_mask, attn_mask=d_mask)[0]
+        sa_output = self.norm1(tgt_input)
+        sa_output = self.self_attention(sa_output, sa_output, sa_output, d_mask)
         sa_output = self.block_connections[0](tgt_input, sa_output)
-        sa_output = self._maybe_layer_norm(sa_output, self.norm1, after=True)
 
         # Positional attention sublayer
-        pos_output = self.positional_encoder(sa_output)
-        pos_output = self._maybe_layer_norm(pos_output, self.norm2, before=True)
-        pos_output = self.pos_attention(pos_output, pos_output, sa_output, d_pad_mask, attn_mask=d_mask)[0]
+        pos_output = self.norm2(sa_output + pe)
+        pos_output = self.pos_attention(pos_output, pos_output, sa_output, d_mask)
         pos_output = self.block_connections[1](sa_output, pos_output)
-        pos_output = self._maybe_layer_norm(pos_output, self.norm2, after=True)
 
         # Encoder-decoder attention sublayer
-        encdec_output = self._maybe_layer_norm(pos_output, self.norm3, before=True)
-        encdec_output = self.encdec_attention(encdec_output, e_output, e_output, e_pad_mask, attn_mask=None)[0]
+        encdec_output = self.norm3(pos_output)
+        encdec_output = self.encdec_attention(encdec_output, e_output, e_output, e_pad_mask)
         encdec_output = self.block_connections[2](pos_output, encdec_output)
-        encdec_output = self._maybe_layer_norm(encdec_output, self.norm3, after=True)
 
         # Feed-forward sublayer
-        output = self._maybe_layer_norm(encdec_output, self.norm4, before=True)
-        output = F.relu(self.ff_linear1(output))
-        output = self.dropout4(output)
-        output = self.ff_linear2(output)
+        output = self._ff_block(self.norm4(encdec_output))
         output = self.block_connections[3](encdec_output, output)
-        output = self._maybe_layer_norm(output, self.norm4, after=True)
         return output
 
 
+class PostNormDecoderLayerNAT(DecoderLayerNAT):
+    """
+    Non-autoregressive decoder layer that performs the LayerNorms after the attention and feedforward sublayers.
+    """
+
+    norm_first = False
+
+    def forward(self,
+                e_output: torch.Tensor,
+                tgt_input: torch.Tensor,
+                pe: torch.Tensor,
+                d_mask: torch.Tensor = None,
+                e_pad_mask: torch.Tensor = None) -> torch.Tensor:
+        # Self-attention sublayer
+        sa_output = self.self_attention(tgt_input, tgt_input, tgt_input, d_mask)
+        sa_output = self.norm1(self.block_connections[0](tgt_input, sa_output))
+
+        # Positional attention sublayer
+        pos_output = sa_output + pe
+        pos_output = self.pos_attention(pos_output, pos_output, sa_output, d_mask)
+        pos_output = self.norm2(self.block_connections[1](sa_output, pos_output))
+
+        # Encoder-decoder attention sublayer
+        encdec_output = self.encdec_attention(pos_output, e_output, e_output, e_pad_mask)
+        encdec_output = self.norm3(self.block_connections[2](pos_output, encdec_output))
+
+        # Feed-forward sublayer
+        output = self._ff_block(encdec_output)
+        output = self.norm4(self.block_connections[3](encdec_output, output))
+        return output
+
+
+def build_decoder_layer_nat(d_model: int = 512,
+                            n_heads: int = 8,
+                            dim_ff: int = 2048,
+                            dropout: float = 0.1,
+                            layer_norm_eps: float = 1e-5,
+                            norm_first: bool = False,
+                            use_highway_layer: bool = False) -> DecoderLayerNAT:
+    """
+    Builds the non-autoregressive decoder layer matching the requested layer normalization placement.
+    :param d_model: the model's embedding dimension (default=512).
+    :param n_heads: the number of heads in the multi-attention mechanism (default=8).
+    :param dim_ff: dimension of the feedforward sublayer (default=2048).
+    :param dropout: the dropout value (default=0.1).
+    :param layer_norm_eps: the eps value in the layer normalization (default=1e-5).
+    :param norm_first: if True, a PreNormDecoderLayerNAT is built, otherwise a PostNormDecoderLayerNAT
+        (default=False).
+    :param use_highway_layer: whether to use a highway connection around each sublayer, if set to False then
+        residual connections will be used (default=False).
+    :return: the non-autoregressive decoder layer.
+    """
+    decoder_layer_cls = PreNormDecoderLayerNAT if norm_first else PostNormDecoderLayerNAT
+    return decoder_layer_cls(d_model, n_heads, dim_ff, dropout, layer_norm_eps, use_highway_layer=use_highway_layer)
+
+
 class DecoderNAT(nn.Module):
 
     def __init__(self,
                  decoder_layer: DecoderLayerNAT,
                  num_decoder_layers: int = 6,
-                 norm: nn.Module = None) -> None:
+                 norm: nn.Module = None,
+                 checkpoint_segments: int = 2) -> None:
         """
         The non-autoregressive transformer decoder by Gu et al. https://arxiv.org/pdf/1711.02281.pdf.
-        :param decoder_layer: the non-autoregressive decoder layer.
+        :param decoder_layer: the non-autoregressive decoder layer, which is cloned num_decoder_layers times.
         :param num_decoder_layers: the number of decoder layers (default=6).
+        :param norm: the layer normalization applied to the decoder's output (default=None).
+        :param checkpoint_segments: number of segments in which the layers are split for activation checkpointing
+            during training, set it to None or 0 to disable checkpointing (default=2).
         """
         super().__init__()
         # Parameters
         self.num_layers = num_decoder_layers
-        self.layers = nn.ModuleList([decoder_layer for _ in range(num_decoder_layers)])
+        self.checkpoint_segments = checkpoint_segments
+        self.layers = nn.ModuleList([copy.deepcopy(decoder_layer) for _ in range(num_decoder_layers)])
         self.norm = norm
 
+    def _forward_layers(self,
+                        start: int,
+                        end: int,
+                        e_output: torch.Tensor,
+                        output: torch.Tensor,
+                        pe: torch.Tensor,
+                        d_mask: torch.Tensor = None,
+                        e_pad_mask: torch.Tensor = None) -> torch.Tensor:
+        for decoder_layer in self.layers[start:end]:
+            output = decoder_layer(e_output, output, pe, d_mask, e_pad_mask)
+
+        return output
+
     def forward(self,
                 e_output: torch.Tensor,
                 tgt_input: torch.Tensor,
+                pe: torch.Tensor,
                 d_mask: torch.Tensor = None,
                 e_pad_mask: torch.Tensor = None,
                 d_pad_mask: torch.Tensor = None) -> torch.Tensor:
         """
         Process masked source and target sequences.
+        :param pe: the model's positional encoding table of shape (1, max_len, d_model), it is sliced to the target
+            length and shared by all the layers for the positional attention.
+        :param d_mask: boolean or additive attention mask for the decoder of shape (seq_len, seq_len).
+        :param e_pad_mask: boolean key padding mask for the encoder of shape (batch_size, seq_len) or additive one of
+            shape (batch_size, 1, 1, seq_len).
+        :param d_pad_mask: boolean key padding mask for the decoder of shape (batch_size, seq_len) or additive one of
+            shape (batch_size, 1, 1, seq_len).
         """
+        # The masks are merged and converted only once, in the dtype the attention runs in, then they are shared by
+        # all the layers
+        device_type = tgt_input.device.type
+        if torch.is_autocast_enabled(device_type):
+            mask_dtype = torch.get_autocast_dtype(device_type)
+        else:
+            mask_dtype = tgt_input.dtype
+
+        d_mask = merge_attention_masks(d_mask, d_pad_mask, mask_dtype)
+        e_pad_mask = merge_attention_masks(None, e_pad_mask, mask_dtype)
+
         output = tgt_input
-        for decoder_layer in self.layers:
-            output = decoder_layer(e_output, output, d_mask, e_pad_mask, d_pad_mask)
+        pe = pe[:, :tgt_input.size(1)]  # (1, seq_len, d_model)
+        if self.checkpoint_segments and self.training and torch.is_grad_enabled():
+            # Only the segments' inputs are kept, activations inside each segment are recomputed during backward
+            segment_size = math.ceil(self.num_layers / self.checkpoint_segments)
+            for start in range(0, self.num_layers, segment_size):
+                output = checkpoint(self._forward_layers, start, start + segment_size, e_output, output, pe,
+                                    d_mask, e_pad_mask, use_reentrant=False)
+        else:
+            output = self._forward_layers(0, self.num_layers, e_output, output, pe, d_mask, e_pad_mask)
 
         if self.norm is not None:
             output = self.norm(output)
@@ -1,6 +1,7 @@
 import torch
+from functools import lru_cache
 from torch import nn
-from typing import Tuple
+from typing import Tuple, Union
 
 
 SUPPORTED_LANGUAGES = {"ar": "ar_AR", "cs": "cs_CZ", "de": "de_DE", "en": "en_XX", "es": "es_XX", "et": "et_EE",
@@ -19,6 +20,18 @@ def generate_causal_mask(seq_len: int) -> torch.Tensor:
     return torch.triu(torch.ones(seq_len, seq_len) * float("-inf"), diagonal=1)
 
 
+@lru_cache(maxsize=None)
+def cached_causal_mask(seq_len: int, device: Union[str, torch.device] = "cpu") -> torch.Tensor:
+    """
+    Returns the causal mask built by generate_causal_mask directly on the requested device. Masks are cached by length
+    and device, so each of them is created and moved only once; the returned tensor must not be modified in place.
+    :param seq_len: length of the sequence to mask.
+    :param device: the device on which the mask should be stored (default="cpu").
+    :return: causal mask for the autoregressive decoder.
+    """
+    return torch.triu(torch.full((seq_len, seq_len), float("-inf"), device=device), diagonal=1)
+
+
 def generate_causal_nat_mask(seq_len: int) -> torch.Tensor:
     """
     Generates a diagonal matrix of -inf, in order to avoid a position from attending to itself.
@@ -28,6 +41,49 @@ def generate_causal_nat_mask(seq_len: int) -> torch.Tensor:
     return torch.diag(torch.ones(seq_len) * float("-inf"))
 
 
+def additive_padding_mask(pad_mask: torch.Tensor, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """
+    Converts a boolean key padding mask into an additive one that can be directly summed to the attention scores.
+    :param pad_mask: boolean key padding mask of shape (batch_size, seq_len), True where the token is a pad.
+    :param dtype: the dtype of the additive mask (default=torch.float32).
+    :return: torch tensor of shape (batch_size, 1, 1, seq_len) with -inf on the pad tokens and zeros elsewhere.
+    """
+    additive_mask = torch.zeros(pad_mask.shape[0], 1, 1, pad_mask.shape[-1], dtype=dtype, device=pad_mask.device)
+    return additive_mask.masked_fill_(pad_mask[:, None, None, :], float("-inf"))
+
+
+def merge_attention_masks(attn_mask: Union[torch.Tensor, None],
+                          key_padding_mask: Union[torch.Tensor, None],
+                          dtype: torch.dtype) -> Union[torch.Tensor, None]:
+    """
+    Merges an attention mask and a key padding mask into a single additive mask that can be directly passed to
+    scaled_dot_product_attention. Boolean masks follow the nn.MultiheadAttention convention (True means the position
+    is not allowed to attend).
+    :param attn_mask: boolean or additive attention mask of shape (tgt_len, src_len), None if not needed.
+    :param key_padding_mask: boolean key padding mask of shape (batch_size, src_len) or additive one of shape
+        (batch_size, 1, 1, src_len), None if not needed.
+    :param dtype: the dtype of the merged mask, it should be the same of the attention's queries.
+    :return: torch tensor broadcastable to (batch_size, n_heads, tgt_len, src_len) or None if both masks are None.
+    """
+    mask = None
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            mask = torch.zeros(attn_mask.shape, dtype=dtype, device=attn_mask.device)
+            mask.masked_fill_(attn_mask, float("-inf"))
+        else:
+            mask = attn_mask.to(dtype)
+
+    if key_padding_mask is not None:
+        if key_padding_mask.dtype == torch.bool:
+            key_padding_mask = additive_padding_mask(key_padding_mask, dtype)
+        else:
+            key_padding_mask = key_padding_mask.to(dtype)
+
+        mask = key_padding_mask if mask is None else mask + key_padding_mask
+
+    return mask
+
+
 def shift_tokens_right(input_ids: torch.Tensor, pad_token_id: int, decoder_start_token_id: int) -> torch.Tensor:
     """
     Shift input ids one token to the right.
@@ -40,9 +96,10 @@ def shift_tokens_right(input_ids: torch.Tensor, pad_token_id: int, decoder_start
     if len(input_ids.shape) == 1:
         input_ids = input_ids.unsqueeze(0)
 
-    shifted_input_ids: torch.Tensor = input_ids.new_zeros(input_ids.shape)
-    shifted_input_ids[:, 1:] = input_ids[:, :-1].clone()
-    shifted_input_ids = torch.where(shifted_input_ids == decoder_start_token_id, pad_token_id, shifted_input_ids)
+    # The shift is done in place on a new tensor on the same device of the input ids
+    shifted_input_ids = torch.empty_like(input_ids)
+    shifted_input_ids[:, 1:] = input_ids[:, :-1]
+    shifted_input_ids.masked_fill_(shifted_input_ids == decoder_start_token_id, pad_token_id)
     shifted_input_ids[:, 0] = decoder_start_token_id
     return shifted_input_ids
 
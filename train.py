@@ -1,16 +1,17 @@
 import torch
+import math
 import yaml
 from transformers import MBartTokenizer
 from datasets import load_dataset
-from torch import nn
+from torch.functional import F
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
-from torch.optim import Adam
+from torch.optim import AdamW
 from torch.optim.lr_scheduler import LambdaLR
 from tqdm import tqdm
-from src.data import TranslationDataset, BatchCollator
+from src.data import TokenizedTranslationDataset, BatchCollator
 from src.models import Transformer
-from src import model_size, model_n_parameters, generate_causal_mask, shift_tokens_right, compute_lr
+from src import model_size, model_n_parameters, cached_causal_mask, shift_tokens_right, compute_lr
 from typing import Dict
 
 
@@ -32,6 +33,9 @@ if __name__ == "__main__":
     verbose = config["verbose_training"]
     log_steps = config["log_steps"]
     shift_labels_right = config["shift_labels_right"]
+    num_workers = config["num_workers"]
+    pad_to_multiple_of = config["pad_to_multiple_of"]
+    compile_model = config["compile_model"]
 
     # Define source and target language
     src_lang = "en"
@@ -47,9 +51,12 @@ if __name__ == "__main__":
                            cache_dir=f"D:/MasterDegreeThesis/datasets/ccmatrix_{src_lang}_{tgt_lang}",
                            split="train[:4096]", verification_mode="no_checks")
 
-    dataset_train = TranslationDataset(src_lang, tgt_lang, dataset)
-    batch_collator = BatchCollator(tokenizer, max_length=max_length, padding=padding)
-    dataloader_train = DataLoader(dataset_train, batch_size, collate_fn=batch_collator, drop_last=True)
+    dataset_train = TokenizedTranslationDataset(src_lang, tgt_lang, dataset, tokenizer, max_length=max_length)
+    batch_collator = BatchCollator(tokenizer, max_length=max_length, padding=padding,
+                                   pad_to_multiple_of=pad_to_multiple_of)
+    dataloader_train = DataLoader(dataset_train, batch_size, collate_fn=batch_collator, drop_last=True,
+                                  num_workers=num_workers, persistent_workers=num_workers > 0,
+                                  pin_memory=device.type == "cuda")
 
     # Model
     transformer = Transformer(len(tokenizer), norm_first=True).to(device)
@@ -60,6 +67,13 @@ if __name__ == "__main__":
           f"\tTrainable parameters: {n_trainable_parameters}\n"
           f"\tSize: {transformer_size}\n")
 
+    # Compile the model, batches are padded to a multiple of pad_to_multiple_of so that each pair of source and
+    # target lengths is compiled only once
+    if compile_model:
+        n_lengths = math.ceil(max_length / pad_to_multiple_of) if pad_to_multiple_of is not None else max_length
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, n_lengths ** 2)
+        transformer = torch.compile(transformer, dynamic=False)
+
     # Useful token ids
     pad_token = tokenizer.pad_token_id
     src_lang_token = tokenizer.lang_code_to_id[langs[src_lang]]
@@ -67,53 +81,76 @@ if __name__ == "__main__":
     sos_token = tokenizer.bos_token_id
     eos_token = tokenizer.eos_token_id
 
-    # Define loss function, optimizer and scheduler
-    loss_fn = nn.CrossEntropyLoss(ignore_index=pad_token, label_smoothing=0.1)
-    optimizer = Adam(transformer.parameters(), lr=5e-5, betas=(0.9, 0.997), eps=1e-9)
+    # Define optimizer and scheduler
+    use_cuda = device.type == "cuda"
+    optimizer = AdamW(transformer.parameters(), lr=5e-5, betas=(0.9, 0.997), eps=1e-9, weight_decay=0.0,
+                      fused=use_cuda)
     # scheduler = LambdaLR(optimizer, lambda steps: compute_lr(steps, transformer.d_model, 4000))
 
+    # Mixed precision on cuda, the loss needs to be scaled only if bfloat16 is not supported
+    amp_dtype = torch.bfloat16 if use_cuda and torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.amp.GradScaler("cuda", enabled=use_cuda and amp_dtype == torch.float16)
+
     # Train loop
     current_step = 0
     epochs = 10
+    n_batches = len(dataloader_train)
     dataloader_tqdm = tqdm(dataloader_train)
     transformer.train()
     board = SummaryWriter()
+    loss_buffer = torch.zeros(log_steps, device=device)
     for epoch in range(epochs):
-        total_loss = 0
+        total_loss = torch.zeros((), device=device)
         for step, batch in enumerate(dataloader_tqdm):
-            # Retrieve encoder inputs and labels, then create decoder inputs
-            input_ids = batch["input_ids"].to(device)
-            labels = batch["labels"].to(device)
+            # Retrieve encoder inputs, labels and encoder padding mask built by the collator
+            input_ids = batch["input_ids"].to(device, non_blocking=True)
+            labels = batch["labels"].to(device, non_blocking=True)
+            e_pad_mask = batch["e_pad_mask"].to(device, non_blocking=True)
+
+            # Create decoder inputs and their padding mask directly on the device
             if shift_labels_right:
-                decoder_input_ids = shift_tokens_right(labels, pad_token, tgt_lang_token).to(device)
+                decoder_input_ids = shift_tokens_right(labels, pad_token, tgt_lang_token)
             else:
-                decoder_input_ids = labels[:, :-1].to(device)
+                decoder_input_ids = labels[:, :-1]
                 labels = labels[:, 1:]
 
-            # Create masks
-            e_pad_mask = (input_ids == pad_token).to(device)
-            d_pad_mask = (decoder_input_ids == pad_token).to(device)
-            d_mask = generate_causal_mask(decoder_input_ids.shape[-1]).to(device)
+            d_pad_mask = decoder_input_ids == pad_token
+
+            # The causal mask only depends on the decoder inputs length, so it is created once for each length
+            d_mask = cached_causal_mask(decoder_input_ids.shape[-1], device)
 
             # Compute predictions and loss
-            logits = transformer(input_ids, decoder_input_ids, d_mask, e_pad_mask, d_pad_mask)
-            loss = loss_fn(logits.contiguous().view(-1, logits.size(-1)), labels.contiguous().view(-1))
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_cuda):
+                logits = transformer(input_ids, decoder_input_ids, d_mask, e_pad_mask, d_pad_mask)
+                loss = F.cross_entropy(logits.reshape(-1, logits.size(-1)), labels.reshape(-1).long(),
+                                       ignore_index=pad_token, label_smoothing=0.1)
 
             # Update weights and do one step for both optmizer and scheduler
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             # scheduler.step()
 
-            total_loss += loss.item()
-            if current_step % log_steps == 0:
-                dataloader_tqdm.set_postfix(loss=str(loss.item)[0:6])
-
+            # Losses are kept on the device and moved to the cpu only once every log_steps steps
+            total_loss += loss.detach()
+            loss_buffer[current_step % log_steps] = loss.detach()
             current_step += 1
-            board.add_scalar("Loss/train", loss, current_step)
             board.add_scalar("Learning rate", optimizer.param_groups[0]["lr"], current_step)
+            if current_step % log_steps == 0:
+                losses = loss_buffer.tolist()
+                for i, step_loss in enumerate(losses):
+                    board.add_scalar("Loss/train", step_loss, current_step - log_steps + i + 1)
+
+                dataloader_tqdm.set_postfix(loss=f"{losses[-1]:.4f}")
+
+        print(f"Epoch {epoch} ended at step {current_step}, "
+              f"Loss: {total_loss.item() / n_batches}\n")
 
-        print(f"Epoch {epoch} ended at step {current_step}, Loss: {total_loss / len(list(dataloader_train))}\n")
+    # Log the losses of the last steps that did not fill the buffer
+    remaining_steps = current_step % log_steps
+    for i, step_loss in enumerate(loss_buffer[:remaining_steps].tolist()):
+        board.add_scalar("Loss/train", step_loss, current_step - remaining_steps + i + 1)
 
     board.flush()
     board.close()